@@ -2,7 +2,7 @@ import sys
 import gzip
 import json
 import threading
-from queue import Queue, Empty
+from queue import Queue
 from queue import SimpleQueue
 
 import click
@@ -52,6 +52,14 @@ def scanThread(inq, outq):
         inq.task_done()
 
 
+def outputThread(outq, output):
+    while True:
+        o = outq.get()
+        if o is None:
+            break
+        print(o, file=output)
+
+
 @click.command()
 @click.option(
     "--input", "-i", "input_", type=click.Path(exists=True, dir_okay=False, ),
@@ -110,15 +118,21 @@ def main(input_, output, logfile, verbose, threads, ns, dump_stats):
             daemon=True,
         ).start()
 
-    enqueue(inf, inq)
+    # Write results as they come in instead of holding them until the end
+    writer = threading.Thread(
+        target=outputThread,
+        args=(outq, output,),
+        daemon=True,
+    )
+    writer.start()
 
-    inq.join()
     try:
-        while True:
-            o = outq.get_nowait()
-            print(o, file=output)
-    except Empty:
-        pass
+        enqueue(inf, inq)
+        inq.join()
+    finally:
+        # Flush what we have, also when interrupted
+        outq.put(None)
+        writer.join()
     logger.info("Finished. Here are some stats:\n%s", report_counts())
     if dump_stats:
         json.dump(
@@ -1,34 +1,98 @@
-from base64 import b32encode
+import asyncio
 import datetime
+import logging
 from hashlib import sha256
 from itertools import chain, groupby
-import random
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+import threading
+import weakref
 
 import dns
+import dns.asyncresolver
+import dns.edns
 import dns.resolver
 import dns.dnssec
-from dns.rdtypes.ANY.NSEC3 import b32_normal_to_hex
+
+try:
+    import aiodns
+except ImportError:  # optional, speeds up address lookups of auths
+    aiodns = None
 
 from .log import logger
 from .stats import record, Event
 
 
-global_auths_map = defaultdict(set)
+# Label separating the child name from the auth hostname in signaling names
+DSAUTH_LABEL = dns.name.Name(['_dsauth'])
+
+# Names are immutable, and the same auth hostnames occur over and over
+name_from_text = lru_cache(maxsize=65536)(dns.name.from_text)
+
+global_auths_map = {}
+global_auths_map_lock = threading.Lock()
+
+# Resolver instances are reused across queries, keyed by nameservers and flags.
+# Resolvers for the host's resolvers are few and kept; resolvers for direct
+# queries to auths are evicted least recently used beyond AUTH_RESOLVER_CACHE_SIZE.
+_RESOLVER_CACHE = {}
+_AUTH_RESOLVER_CACHE = OrderedDict()
+_RESOLVER_CACHE_LOCK = threading.Lock()
+AUTH_RESOLVER_CACHE_SIZE = 4096
+
+# Extended DNS Errors (RFC 8914) signaling that DNSSEC validation failed
+DNSSEC_FAILURE_EDE_CODES = {
+    dns.edns.EDECode.DNSSEC_BOGUS,
+    dns.edns.EDECode.SIGNATURE_EXPIRED,
+    dns.edns.EDECode.SIGNATURE_NOT_YET_VALID,
+    dns.edns.EDECode.DNSKEY_MISSING,
+    dns.edns.EDECode.RRSIGS_MISSING,
+    dns.edns.EDECode.NO_ZONE_KEY_BIT_SET,
+    dns.edns.EDECode.NSEC_MISSING,
+}
+
+# Upper bound of names visited per NSEC walk, in case a chain does not terminate
+NSEC_WALK_LIMIT = 100000
+
+# DNSSEC validation is CPU-bound and mostly releases the GIL, so it runs here
+# instead of blocking the event loop
+validation_executor = ThreadPoolExecutor()
+
+# Upper bound of concurrently outstanding queries per event loop
+QUERY_CONCURRENCY = 64
+_query_semaphores = weakref.WeakKeyDictionary()
 
 
 # https://docs.python.org/3/library/itertools.html#itertools-recipes
-# We can't use len(set(...)) == 1 because set elements need to be hashable,
-# but the RRsets we want to check aren't.
 def all_equal(iterable):
     "Returns True if all the elements are equal to each other"
     g = groupby(iterable)
     return next(g, True) and not next(g, False)
 
 
-def next_nsec_prefix(prefix, ancestor):
+def rrset_digest(rrset):
+    """
+    Return a digest of the RRset's rdata in canonical wire format, so that
+    RRsets can be compared by value cheaply.  Returns None for None.
+    """
+    if rrset is None:
+        return None
+    rdatas = sorted(rd.to_digestable() for rd in rrset)
+    return sha256(b''.join(len(rd).to_bytes(2, 'big') + rd for rd in rdatas)).digest()
+
+
+def wire_to_text(rdtype, wires):
+    """Return the presentation format of rdata given in wire format"""
+    return {
+        dns.rdata.from_wire(dns.rdataclass.IN, rdtype, wire, 0, len(wire)).to_text()
+        for wire in wires
+    }
+
+
+async def next_nsec_prefix(prefix, ancestor):
     qname = prefix + ancestor
-    res = query_dns(qname, 'NSEC')
+    res = await query_dns(qname, 'NSEC')
     try:
         rrset, = [rrset for rrset in chain(res.response.answer, res.response.authority)
                   if rrset.rdtype == dns.rdatatype.RdataType.NSEC]
@@ -39,23 +103,32 @@ def next_nsec_prefix(prefix, ancestor):
     return next_name - ancestor if next_name.is_subdomain(ancestor) else None
 
 
-def check_auths(domain, auths):
+async def check_auths(domain, auths):
     logger.warning(f"Confirming NS RRset for delegation {domain} via DNS. "
                    f"In production, the parental agent MUST retrieve this from its local database!")
-    parent = dns.name.from_text(domain).parent()  # tentative parent
-    parent = dns.resolver.zone_for_name(parent, resolver=get_resolver())  # real parent (perhaps higher up)
+    parent = name_from_text(domain).parent()  # tentative parent
+    try:
+        async with _get_query_semaphore():
+            parent = await dns.asyncresolver.zone_for_name(parent, resolver=get_resolver())  # real parent (perhaps higher up)
+    except dns.exception.DNSException as e:
+        logger.info(f'Skipping {domain} (could not determine parent zone: {e}).')
+        record(parent, Event.DNS_FAILURE)
+        return False
 
-    res = query_dns(parent, 'NS')
-    if res is None:
+    res = await query_dns(parent, 'NS')
+    if res is None or res.rrset is None:
         record(parent, Event.DNS_FAILURE)
         return False
 
     ns = [rr.target.to_text() for rr in res.rrset]
-    update_auths_map(ns)
-    nameservers = [global_auths_map[target] for target in ns]  # list of list of IPs
-    nameservers = list({ip for nameserver in nameservers for ip in nameserver})  # flat list of IPs
+    ns_map = await update_auths_map(ns)
+    nameservers = {ip for addresses in ns_map.values() for ip in addresses}  # flat set of IPs
+    if not nameservers:
+        logger.info(f'Skipping {domain} (could not resolve parent nameservers).')
+        record(parent, Event.DNS_FAILURE)
+        return False
 
-    res = query_dns(domain, 'NS', nameservers=nameservers)
+    res = await query_dns(domain, 'NS', nameservers=nameservers)
     if res is None:  # NXDOMAIN
         logger.info(f'Skipping {domain} (could not retrieve NS records from parent).')
         record(parent, Event.DNS_FAILURE)
@@ -68,34 +141,121 @@ def check_auths(domain, auths):
         record(parent, Event.DNS_FAILURE)
         return False
 
-    if sorted(auths) != sorted([ns.target.to_text() for ns in rrset]):
+    # Name comparison is case-insensitive, and duplicates don't matter
+    if {name_from_text(auth) for auth in auths} != {ns.target for ns in rrset}:
         logger.info(f'Skipping {domain} which is delegated to other nameservers.')
         return False
     else:
         return True
 
 
-def walk_ancestor(ancestor, auths):
-    prefix_map = {auth: set() for auth in auths}
-    for auth in auths:
-        entrypoint = ancestor - dns.name.root + dns.name.Name(['_dsauth']) + dns.name.from_text(auth)
-        next_prefix = next_nsec_prefix(dns.name.Name([]), entrypoint)
-        while next_prefix:
-            prefix_map[auth].add(next_prefix)
-            next_prefix = next_nsec_prefix(next_prefix, entrypoint)
-    candidates = {str(prefix + ancestor) for prefix in set.intersection(*prefix_map.values())}
-    return [' '.join([candidate, *auths]) for candidate in candidates if check_auths(candidate, auths)]
+async def walk_nsec_chain(entrypoint):
+    """Return the set of prefixes found by walking the NSEC chain below entrypoint"""
+    prefixes = set()
+    next_prefix = await next_nsec_prefix(dns.name.empty, entrypoint)
+    for _ in range(NSEC_WALK_LIMIT):
+        # Stop when the chain is exhausted or loops back to a known name
+        if not next_prefix or next_prefix in prefixes:
+            break
+        prefixes.add(next_prefix)
+        next_prefix = await next_nsec_prefix(next_prefix, entrypoint)
+    else:
+        logger.warning(f"Aborting NSEC walk of {entrypoint} after {NSEC_WALK_LIMIT} names")
+    return prefixes
+
+
+async def walk_ancestor(ancestor, auths):
+    # The signaling prefix is the same for all auths
+    signaling_prefix = ancestor - dns.name.root + DSAUTH_LABEL
+    # The walks are independent per auth, so run them concurrently
+    prefix_sets = await asyncio.gather(*(
+        walk_nsec_chain(signaling_prefix + name_from_text(auth)) for auth in auths
+    ))
+    candidates = [str(prefix + ancestor) for prefix in set.intersection(*prefix_sets)]
+    checks = await asyncio.gather(*(check_auths(candidate, auths) for candidate in candidates))
+    return [' '.join([candidate, *auths]) for candidate, ok in zip(candidates, checks) if ok]
+
 
+async def resolve_addresses(host, rdtype):
+    """
+    Return the list of addresses of given type for host (empty if there are
+    none), or None if the lookup failed.
+    """
+    try:
+        res = await query_dns(host, rdtype, raise_nxdomain=True)
+    except dns.resolver.NXDOMAIN:
+        return []
+    if res is None:
+        return None
+    return [a.address for a in res]
 
-def update_auths_map(auths):
-    for auth in auths:
-        if auth not in global_auths_map:
-            for rdtype in ["AAAA", "A"]:
-                r = dns.resolver.resolve(auth, rdtype, raise_on_no_answer=False)
-                global_auths_map[auth] |= {a.address for a in r}
+
+async def update_auths_map(auths):
+    """
+    Return a dict with the set of addresses of each auth, resolving those
+    not yet in global_auths_map.  Only conclusive results (including
+    nonexistent names or records) are stored there; auths whose lookup
+    failed are tried again next time.
+    """
+    with global_auths_map_lock:
+        auths_map = {auth: global_auths_map.get(auth) for auth in auths}
+    missing = [auth for auth, addresses in auths_map.items() if addresses is None]
+    if not missing:
+        return auths_map
+    queries = [(auth, rdtype) for auth in missing for rdtype in ["AAAA", "A"]]
+    if aiodns is not None:
+        results = await resolve_addresses_aiodns(queries)
+    else:
+        results = await asyncio.gather(*(resolve_addresses(auth, rdtype) for auth, rdtype in queries))
+
+    failed = set()
+    for auth in missing:
+        auths_map[auth] = set()
+    for (auth, _), addresses in zip(queries, results):
+        if addresses is None:
+            failed.add(auth)
+        else:
+            auths_map[auth] |= set(addresses)
+    with global_auths_map_lock:
+        for auth in missing:
+            if auth not in failed:
+                global_auths_map[auth] = auths_map[auth]
+    return auths_map
+
+
+async def resolve_addresses_aiodns(queries):
+    """
+    Resolve (hostname, rdtype) address queries with c-ares via aiodns.
+    Returns a list of addresses per query like resolve_addresses().  This is
+    only suitable for plain recursive lookups; signed queries need dnspython.
+    """
+    async def resolve(resolver, host, rdtype):
+        try:
+            async with _get_query_semaphore():
+                res = await resolver.query_dns(host, rdtype)
+        except aiodns.error.DNSError as e:
+            errno = e.args[0] if e.args else None
+            if errno in (aiodns.error.ARES_ENOTFOUND, aiodns.error.ARES_ENODATA):
+                return []
+            if errno == aiodns.error.ARES_ETIMEOUT:
+                logger.warning(f"DNS timeout for domain: {host}")
+                record(host, Event.DNS_TIMEOUT)
+                return None
+            # Have other failures (bogus, lame, ...) classified like without aiodns
+            return await resolve_addresses(host, rdtype)
+        rdtype_value = dns.rdatatype.from_text(rdtype)
+        return [rr.data.addr for rr in res.answer if rr.type == rdtype_value]
+
+    async with aiodns.DNSResolver(nameservers=get_resolver().nameservers) as resolver:
+        return await asyncio.gather(*(resolve(resolver, host, rdtype) for host, rdtype in queries))
 
 
 def do_scan(obj):
+    """Synchronous wrapper around do_scan_async()"""
+    return asyncio.run(do_scan_async(obj))
+
+
+async def do_scan_async(obj):
     """
     Scan for CDS/CDNSKEY records for given tuple of child domain and its
     authoritative nameserver hostnames.
@@ -106,15 +266,15 @@ def do_scan(obj):
     if domain[0] == '.':
         domain = domain[1:]
         logger.info(f'Performing NSEC walk of {domain} on {auths} ...')
-        return walk_ancestor(dns.name.from_text(domain), auths)
+        return await walk_ancestor(name_from_text(domain), auths)
 
-    domain = dns.name.from_text(domain.lower())
+    domain = name_from_text(domain.lower())
     logger.info(f"Processing domain: {domain}")
 
     # TODO move steps to separate functions, add unit tests
 
     ### Step 1
-    ds = query_dns(domain, 'DS')
+    ds = await query_dns(domain, 'DS')
     if ds is None:
         record(domain, Event.DNS_FAILURE)
         return
@@ -122,34 +282,56 @@ def do_scan(obj):
         record(domain, Event.HAVE_DS)
         return
 
-    # Fetch auth IP addresses
-    update_auths_map(auths)
-    auths_map = {k: v for k, v in global_auths_map.items() if k in auths}
+    # Fetch auth IP addresses; all auths are needed for the consistency checks
+    auths_map = await update_auths_map(auths)
+    if not all(auths_map.values()):
+        logger.info(f'Skipping {domain} (could not resolve all of its nameservers).')
+        record(domain, Event.DNS_FAILURE)
+        return
 
     ### Step 2
-    res = fetch_rrset_with_consistency(domain, 'CDS', auths_map)
-    if res is None:
+    cds_res, cdnskey_res = await asyncio.gather(
+        fetch_rrset_with_consistency(domain, 'CDS', auths_map),
+        fetch_rrset_with_consistency(domain, 'CDNSKEY', auths_map),
+    )
+    if cds_res is False or cdnskey_res is False:  # query failure, recorded already
+        return
+    if cds_res is None:
         record(domain, Event.CHILD_CDS_INCONSISTENT)
         return
-    cds_map = {None: res}
+    cds_map = {None: cds_res}
 
-    res = fetch_rrset_with_consistency(domain, 'CDNSKEY', auths_map)
-    if res is None:
+    if cdnskey_res is None:
         record(domain, Event.CHILD_CDNSKEY_INCONSISTENT)
         return
-    cdnskey_map = {None: res}
+    cdnskey_map = {None: cdnskey_res}
 
     ### Step 3
-    signaling_fqdns = {domain - dns.name.root + dns.name.Name(['_dsauth']) + dns.name.from_text(auth) for auth in auths}
+    signaling_prefix = domain - dns.name.root + DSAUTH_LABEL
+    signaling_fqdns = list({signaling_prefix + name_from_text(auth) for auth in auths})
+
+    def fetch_signaling(rdtype):
+        return asyncio.gather(*(
+            query_dns_and_extract_rdata(signaling_fqdn, rdtype) for signaling_fqdn in signaling_fqdns
+        ))
+
+    if not cds_res and not cdnskey_res:
+        # Nothing at the child.  If there's no CDS at the signaling names
+        # either, this is a no-op, and CDNSKEY needn't be asked for.
+        cds_results = await fetch_signaling('CDS')
+        if all(res is None for res in cds_results):
+            cdnskey_results = [None] * len(signaling_fqdns)
+        else:
+            cdnskey_results = await fetch_signaling('CDNSKEY')
+    else:
+        cds_results, cdnskey_results = await asyncio.gather(fetch_signaling('CDS'), fetch_signaling('CDNSKEY'))
 
-    for signaling_fqdn in signaling_fqdns:
-        res = query_dns_and_extract_rdata(signaling_fqdn, 'CDS')
+    for signaling_fqdn, res in zip(signaling_fqdns, cds_results):
         if res is None:
             record(domain, Event.NO_CDS)
         else:
             cds_map[signaling_fqdn] = res
-    for signaling_fqdn in signaling_fqdns:
-        res = query_dns_and_extract_rdata(signaling_fqdn, 'CDNSKEY')
+    for signaling_fqdn, res in zip(signaling_fqdns, cdnskey_results):
         if res is None:
             record(domain, Event.NO_CDNSKEY)
         else:
@@ -168,27 +350,47 @@ def do_scan(obj):
     if not cds and not cdnskey:
         record(domain, Event.BOOT_NOOP)
         return
-    logger.debug(f"CDS rdataset: {cds}")
-    logger.debug(f"CDNSKEY rdataset: {cdnskey}")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug(f"CDS rdataset: {wire_to_text(dns.rdatatype.CDS, cds)}")
+        logger.debug(f"CDNSKEY rdataset: {wire_to_text(dns.rdatatype.CDNSKEY, cdnskey)}")
 
     ### Step 5
+    # CDS and DS rdata have the same wire format
     ds = dns.rrset.RRset(domain, dns.rdataclass.IN, dns.rdatatype.DS)
-    for rdata in cds:
-        ds.add(dns.rdata.from_text(dns.rdataclass.IN, dns.rdatatype.DS, rdata))
+    for wire in cds:
+        ds.add(dns.rdata.from_wire(dns.rdataclass.IN, dns.rdatatype.DS, wire, 0, len(wire)))
     # TODO do something with CDNSKEY?
     logger.debug(f"DS set: {ds}")
 
     ### Step 6
-    dnskeyset = {
-        auth: query_dns(domain, 'DNSKEY', nameservers)
-        for auth, nameservers in auths_map.items()
-    }
-    if not all_equal([dnskey.rrset for dnskey in dnskeyset.values()]):
-        record(domain, Event.CHILD_DNSKEY_INCONSISTENT)
-        return
-    dnskeyset = next(iter(dnskeyset.values()))
-
-    if not check_continuity(ds, dnskeyset):
+    # Compare answers as they arrive, and stop at the first mismatch
+    tasks = [
+        asyncio.ensure_future(query_dns(domain, 'DNSKEY', nameservers)) for nameservers in auths_map.values()
+    ]
+    dnskeyset = digest = continuity = None
+    try:
+        for next_dnskeyset in asyncio.as_completed(tasks):
+            res = await next_dnskeyset
+            if res is None:
+                record(domain, Event.DNS_FAILURE)
+                if continuity is not None:
+                    continuity.cancel()
+                return
+            if dnskeyset is None:
+                dnskeyset, digest = res, rrset_digest(res.rrset)
+                # Start validating while the other auths' answers are outstanding
+                continuity = asyncio.get_running_loop().run_in_executor(
+                    validation_executor, check_continuity, ds, dnskeyset,
+                )
+            elif rrset_digest(res.rrset) != digest:
+                record(domain, Event.CHILD_DNSKEY_INCONSISTENT)
+                continuity.cancel()
+                return
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    if not await continuity:
         record(domain, Event.CONTINUITY_ERR)
         logger.warning(f"DNSKEY of {domain} not properly signed")
         return
@@ -196,36 +398,103 @@ def do_scan(obj):
     return ds
 
 
-def get_resolver(nameservers=None):
-    default_resolver = dns.resolver.get_default_resolver()
-    # We use separate resolver instance per query
-    resolver = dns.resolver.Resolver(configure=False)
+def get_resolver(nameservers=None, flags=None):
+    """
+    Return a resolver for the given nameservers (default: the host's
+    resolvers).  Instances are cached and shared, so don't modify them.
+    """
+    if nameservers is None:
+        try:
+            return _RESOLVER_CACHE[flags]
+        except KeyError:
+            pass
+    else:
+        key = (frozenset(nameservers), flags)
+        with _RESOLVER_CACHE_LOCK:
+            try:
+                _AUTH_RESOLVER_CACHE.move_to_end(key)
+                return _AUTH_RESOLVER_CACHE[key]
+            except KeyError:
+                pass
+
+    resolver = dns.asyncresolver.Resolver(configure=False)
     if nameservers is None:
-        resolver.nameservers = default_resolver.nameservers
-        if default_resolver.rotate:
-            random.shuffle(resolver.nameservers)
-        resolver.flags = dns.flags.RD
+        # Only consulted when the cache is populated, i.e. once per flags
+        # value; the CLI has applied --ns to the default resolver by then.
+        default_resolver = dns.resolver.get_default_resolver()
+        resolver.nameservers = list(default_resolver.nameservers)
+        resolver.rotate = default_resolver.rotate
+        resolver.flags = dns.flags.RD if flags is None else flags
+        # Answers from the host's resolvers are reused, e.g. auth addresses
+        resolver.cache = dns.resolver.LRUCache(10000)
     else:
         resolver.nameservers = list(nameservers)
+        resolver.flags = flags
         # TODO When querying auths directly, there's no resolver doing validation.  Add timestamp check etc.
-    resolver.use_edns(0, dns.flags.DO, 1200)
-    return resolver
+    # Same as use_edns(0, dns.flags.DO, 1200), without the argument juggling
+    resolver.edns = 0
+    resolver.ednsflags = dns.flags.DO
+    resolver.payload = 1200
+    with _RESOLVER_CACHE_LOCK:
+        if nameservers is None:
+            return _RESOLVER_CACHE.setdefault(flags, resolver)
+        resolver = _AUTH_RESOLVER_CACHE.setdefault(key, resolver)
+        while len(_AUTH_RESOLVER_CACHE) > AUTH_RESOLVER_CACHE_SIZE:
+            _AUTH_RESOLVER_CACHE.popitem(last=False)
+        return resolver
+
+
+def _get_query_semaphore():
+    """Return the semaphore limiting concurrent queries in the running event loop"""
+    loop = asyncio.get_running_loop()
+    try:
+        return _query_semaphores[loop]
+    except KeyError:
+        return _query_semaphores.setdefault(loop, asyncio.Semaphore(QUERY_CONCURRENCY))
+
+
+async def query_dns(domain, rdtype, nameservers=None, raise_nxdomain=False):
+    """
+    Make a query to the local resolver. Return answer object, or None on
+    failure.  With raise_nxdomain, NXDOMAIN is raised instead.
+    """
+    async with _get_query_semaphore():
+        return await _query_dns(domain, rdtype, nameservers, raise_nxdomain)
 
 
-def query_dns(domain, rdtype, nameservers=None):
-    """Make a query to the local resolver. Return answer object."""
+def is_dnssec_failure(exc):
+    """
+    Return True if any server response in the NoNameservers exception
+    carries an Extended DNS Error indicating a DNSSEC validation failure.
+    """
+    for *_, response in exc.kwargs.get('errors') or []:
+        if response is None:
+            continue
+        for option in response.options:
+            if option.otype == dns.edns.OptionType.EDE and option.code in DNSSEC_FAILURE_EDE_CODES:
+                return True
+    return False
+
+
+async def _query_dns(domain, rdtype, nameservers, raise_nxdomain):
     logger.debug(f'Querying {rdtype} for {domain} ...')
     resolver = get_resolver(nameservers)
     try:
-        return resolver.resolve(domain, rdtype, raise_on_no_answer=False)
-    except dns.resolver.NoNameservers:
+        return await resolver.resolve(domain, rdtype, raise_on_no_answer=False)
+    except dns.resolver.NXDOMAIN:
+        if raise_nxdomain:
+            raise
+        logger.debug(f"NXDOMAIN for {rdtype} {domain}")
+    except dns.resolver.NoNameservers as e:
         # Is this a DNSSEC failure?
+        if is_dnssec_failure(e):
+            logger.warning(f"Bogus DNSSEC for domain: {domain}")
+            record(domain, Event.DNS_BOGUS)
+            return
+        # Without EDE, find out by re-querying with checking disabled
         try:
-            try:
-                resolver.flags |= dns.flags.CD
-            except TypeError:  # None
-                resolver.flags = dns.flags.CD
-            resolver.resolve(domain, rdtype, raise_on_no_answer=False)
+            flags = (resolver.flags or 0) | dns.flags.CD
+            await get_resolver(nameservers, flags).resolve(domain, rdtype, raise_on_no_answer=False)
             logger.warning(f"Bogus DNSSEC for domain: {domain}")
             record(domain, Event.DNS_BOGUS)
         except dns.exception.DNSException as e:
@@ -254,58 +523,72 @@ def filter_dnskey_set(dnskeyset, dsset):
     Return a set of DNSKEYs with only keys
     matching fingerprints in the dsset.
     """
+    ds_by_tag = defaultdict(list)
+    for ds in dsset:
+        ds_by_tag[ds.key_tag].append(ds)
+
     s = set()
     for dnskey in dnskeyset:
-        key_id = dns.dnssec.key_id(dnskey)
-        for ds in dsset:
-            if ds.key_tag != key_id:
-                continue
-            try:
-                if ds == dns.dnssec.make_ds(
-                    dnskeyset.name,
-                    dnskey,
-                    ds.digest_type,
-                ):
-                    s.add(dnskey)
-            except dns.dnssec.UnsupportedAlgorithm:
-                pass
+        matches = ds_by_tag.get(dns.dnssec.key_id(dnskey))
+        if not matches:
+            continue
+        made = {}  # computed DS per digest type
+        for ds in matches:
+            if ds.digest_type not in made:
+                try:
+                    made[ds.digest_type] = dns.dnssec.make_ds(
+                        dnskeyset.name,
+                        dnskey,
+                        ds.digest_type,
+                    )
+                except dns.dnssec.UnsupportedAlgorithm:
+                    made[ds.digest_type] = None
+            if ds == made[ds.digest_type]:
+                s.add(dnskey)
+                break
     return s
 
 
-def fetch_rrset_with_consistency(domain, rdtype, auths_map):
-    rds = [query_dns(domain, rdtype, nameservers) for nameservers in auths_map.values()]
-    if not all_equal([v.rrset for v in rds]):
+async def fetch_rrset_with_consistency(domain, rdtype, auths_map):
+    """
+    Query all auths and return the rdata (in wire format) if their answers
+    agree, None if they don't, or False if a query failed.
+    """
+    rds = await asyncio.gather(*(query_dns(domain, rdtype, nameservers) for nameservers in auths_map.values()))
+    if any(v is None for v in rds):
+        record(domain, Event.DNS_FAILURE)
+        return False
+    if len({rrset_digest(v.rrset) for v in rds}) != 1:
         return
-    return {rd.to_text() for rd in rds[0]}
+    return frozenset(rd.to_digestable() for rd in rds[0])
 
 
-def query_dns_and_extract_rdata(qname, rdtype):
-    res = query_dns(qname, rdtype)
+async def query_dns_and_extract_rdata(qname, rdtype):
+    res = await query_dns(qname, rdtype)
     if res is None:
         record(qname, Event.DNS_FAILURE)
         return None
     elif res.rrset is None:
         return None
-    return {rd.to_text() for rd in res}
+    return frozenset(rd.to_digestable() for rd in res)
 
 
-def check_continuity(cds, dnskeyset):
+def check_continuity(ds, dnskeyset):
     """
-    Check if the CDS, when applied, will not break the current delegation
-    as per RFC 7344 section 4.1
+    Check if the DS set built from CDS, when applied, will not break the
+    current delegation as per RFC 7344 section 4.1
 
     In a nutshell this means that at least one of the CDS rdata must be
     used to sign zone's DNSKEY record for each signature algorithm present.
     """
     dssets = defaultdict(set)
-    for ds in (
-        dns.rdata.from_text(
-            dns.rdataclass.IN,
-            dns.rdatatype.DS,
-            rdata.to_text(),
-        ) for rdata in cds
-    ):
-        dssets[ds.algorithm].add(ds)
+    for rdata in ds:
+        dssets[rdata.algorithm].add(rdata)
+    # Validation can't succeed for an algorithm without any DNSKEY, so
+    # don't bother with digests and signatures in that case
+    dnskey_algs = {dnskey.algorithm for dnskey in dnskeyset}
+    if not dnskey_algs.issuperset(dssets):
+        return False
     try:
         for alg, dsset in dssets.items():
             logger.debug(
@@ -313,10 +596,12 @@ def check_continuity(cds, dnskeyset):
                 dns.dnssec.algorithm_to_text(alg),
             )
             keyset = filter_dnskey_set(dnskeyset, dsset)
+            if not keyset:
+                return False
             dns.dnssec.validate(
                 dnskeyset.rrset,
                 get_rrsigset(dnskeyset.response),
-                {cds.name: keyset},
+                {ds.name: keyset},
             )
         return True
     except dns.dnssec.ValidationFailure:
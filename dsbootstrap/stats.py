@@ -1,9 +1,9 @@
 from enum import Enum, auto
 from collections import defaultdict
-from queue import SimpleQueue
+import threading
 
 _RECORDS = defaultdict(list)
-_rq = SimpleQueue()
+_LOCK = threading.Lock()
 
 
 class Event(Enum):
@@ -30,26 +30,22 @@ class Event(Enum):
 
 def record(domain: str, event: Event):
     """Record an event during processing a domain name"""
-    _rq.put((domain, event, ))
-
-
-def _process_queue():
-    while not _rq.empty():
-        domain, event = _rq.get_nowait()
+    with _LOCK:
         _RECORDS[event].append(domain)
 
 
 def report_counts():
     """Return simple report of recorded events"""
-    _process_queue()
     output = []
+    with _LOCK:
+        counts = {event: len(domains) for event, domains in _RECORDS.items()}
     for name, event in Event.__members__.items():
-        count = len(_RECORDS[event])
+        count = counts.get(event, 0)
         output.append(f"{name:<20} {count}")
     return "\n".join(output)
 
 
 def report_domains():
     """Return dictionary with all recorded events."""
-    _process_queue()
-    return dict(_RECORDS)
+    with _LOCK:
+        return {event: list(domains) for event, domains in _RECORDS.items()}
@@ -16,7 +16,8 @@ setup(
     packages=["dsbootstrap"],
     setup_requires=["pytest-runner"],
     python_requires=">=3.7",
-    install_requires=["dnspython", "cryptography", "click"],
+    install_requires=["dnspython>=2.2", "cryptography", "click"],
+    extras_require={"aiodns": ["aiodns>=4"]},
     tests_require=["pytest"],
     entry_points={
         "console_scripts": [
@@ -1,17 +1,25 @@
+import asyncio
+
 import dns
+import dns.edns
+import dns.flags
+import dns.message
+import dns.rcode
 import dns.rdtypes.ANY.CDS
+import dns.resolver
 from dsbootstrap import scanner
+from dsbootstrap.stats import Event
 
 
 def test_query_dns():
-    a = scanner.query_dns("ripe.net", "SOA")
+    a = asyncio.run(scanner.query_dns("ripe.net", "SOA"))
     assert a is not None
 
 
 def test_check_inception_date():
     obj = {"last-modified": "1970-01-01T00:00:00Z"}
     # We query for SOA to make sure it is always there
-    cds = scanner.query_dns("ripe.net", "SOA")
+    cds = asyncio.run(scanner.query_dns("ripe.net", "SOA"))
     assert scanner.check_inception_date(obj, cds)
     obj = {"last-modified": "2100-01-01T00:00:00Z"}
     assert not scanner.check_inception_date(obj, cds)
@@ -93,3 +101,128 @@ def test_filter_dnskey_set():
     filtered = scanner.filter_dnskey_set(keyset, dsset)
     assert dskey_example_com_dnskey in filtered
     assert example_com_dnskey not in filtered
+
+
+def test_rrset_digest():
+    rrset = dns.rrset.from_text("example.", 3600, "IN", "NS", "ns1.example.", "ns2.example.")
+    same = dns.rrset.from_text("example.", 60, "IN", "NS", "NS2.example.", "ns1.example.")
+    other = dns.rrset.from_text("example.", 3600, "IN", "NS", "ns1.example.")
+    assert scanner.rrset_digest(rrset) == scanner.rrset_digest(same)
+    assert scanner.rrset_digest(rrset) != scanner.rrset_digest(other)
+    assert scanner.rrset_digest(None) is None
+
+
+def test_is_dnssec_failure():
+    query = dns.message.make_query("example.", "SOA", want_dnssec=True)
+
+    def servfail(*options):
+        response = dns.message.make_response(query)
+        response.set_rcode(dns.rcode.SERVFAIL)
+        response.use_edns(0, options=list(options))
+        return dns.resolver.NoNameservers(
+            request=query, errors=[("192.0.2.1", False, 53, "SERVFAIL", response)],
+        )
+
+    bogus = dns.edns.EDEOption(dns.edns.EDECode.DNSSEC_BOGUS)
+    unreachable = dns.edns.EDEOption(dns.edns.EDECode.NO_REACHABLE_AUTHORITY)
+    assert scanner.is_dnssec_failure(servfail(bogus))
+    assert not scanner.is_dnssec_failure(servfail(unreachable))
+    assert not scanner.is_dnssec_failure(servfail())
+
+
+def test_check_continuity_algorithm_mismatch():
+    keyset = dns.rrset.from_text(
+        "example.", 3600, "IN", "DNSKEY",
+        "257 3 5 AQPSKmynfzW4kyBv015MUG2DeIQ3Cbl+BBZH4b/0PY1kxkmvHjcZc8no"
+        "kfzj31GajIQKY+5CptLr3buXA10hWqTkF7H6RfoRqXQeogmMHfpftf6z"
+        "Mv1LyBUgia7za6ZEzOJBOztyvhjL742iU/TpPSEDhm2SNKLijfUppn1U"
+        "aNvv4w==",
+    )
+    ds = dns.rrset.from_text("example.", 0, "IN", "DS", "60485 13 2 " + "00" * 32)
+    # No signature checking needed (or possible, as there is no response)
+    assert not scanner.check_continuity(ds, keyset)
+
+
+def test_get_resolver_cache():
+    resolver = scanner.get_resolver({"192.0.2.1", "192.0.2.2"})
+    assert scanner.get_resolver(["192.0.2.2", "192.0.2.1"]) is resolver
+    assert scanner.get_resolver(["192.0.2.1"], dns.flags.CD) is not resolver
+    # Answers from auths are not reused, so they are not kept either
+    assert resolver.cache is None
+
+
+class FakeAnswer:
+    """Stand-in for dns.resolver.Answer"""
+    def __init__(self, rrset=None):
+        self.rrset = rrset
+
+    def __iter__(self):
+        return iter(self.rrset or ())
+
+    def __len__(self):
+        return len(self.rrset or ())
+
+
+def mock_dns(monkeypatch, answers, addresses):
+    """
+    Serve queries from answers, keyed by (qname, rdtype) or, for queries
+    to auths, (qname, rdtype, address).  addresses maps auths to their
+    IPv4 addresses, or None if the lookup fails.  Returns the lists of
+    events recorded and queries made.
+    """
+    events, queries = [], []
+
+    async def query_dns(domain, rdtype, nameservers=None, raise_nxdomain=False):
+        queries.append((str(domain), rdtype, nameservers))
+        if nameservers is not None:
+            address, = nameservers
+            return FakeAnswer(answers.get((str(domain), rdtype, address)))
+        return FakeAnswer(answers.get((str(domain), rdtype)))
+
+    async def resolve_addresses(host, rdtype):
+        if addresses[host] is None:
+            return None
+        return addresses[host] if rdtype == "A" else []
+
+    monkeypatch.setattr(scanner, "aiodns", None)
+    monkeypatch.setattr(scanner, "global_auths_map", {})
+    monkeypatch.setattr(scanner, "query_dns", query_dns)
+    monkeypatch.setattr(scanner, "resolve_addresses", resolve_addresses)
+    monkeypatch.setattr(scanner, "record", lambda domain, event: events.append((str(domain), event)))
+    return events, queries
+
+
+def test_do_scan_unresolved_auth(monkeypatch):
+    events, queries = mock_dns(monkeypatch, {}, {"ns1.example.": ["192.0.2.1"], "ns2.example.": None})
+    assert scanner.do_scan(["child.example.", "ns1.example.", "ns2.example."]) is None
+    assert ("child.example.", Event.DNS_FAILURE) in events
+    # The other auth alone must not be used
+    assert [rdtype for _, rdtype, _ in queries] == ["DS"]
+
+
+def test_walk_nsec_chain_loop(monkeypatch):
+    a, b, c = (dns.name.Name([label]) for label in "abc")
+    nsec_chain = {dns.name.empty: a, a: b, b: c, c: a}
+
+    async def next_nsec_prefix(prefix, ancestor):
+        return nsec_chain[prefix]
+
+    monkeypatch.setattr(scanner, "next_nsec_prefix", next_nsec_prefix)
+    assert asyncio.run(scanner.walk_nsec_chain(dns.name.from_text("example."))) == {a, b, c}
+
+
+def test_do_scan_dnskey_inconsistent(monkeypatch):
+    cds = dns.rrset.from_text("child.example.", 3600, "IN", "CDS", "12345 13 2 " + "00" * 32)
+    answers = {
+        ("child.example.", "CDS", "192.0.2.1"): cds,
+        ("child.example.", "CDS", "192.0.2.2"): cds,
+        ("child._dsauth.ns1.example.", "CDS"): cds,
+        ("child._dsauth.ns2.example.", "CDS"): cds,
+    }
+    for address, key in [("192.0.2.1", "A" * 88), ("192.0.2.2", "B" * 88)]:
+        answers[("child.example.", "DNSKEY", address)] = dns.rrset.from_text(
+            "child.example.", 3600, "IN", "DNSKEY", "257 3 13 " + key,
+        )
+    events, _ = mock_dns(monkeypatch, answers, {"ns1.example.": ["192.0.2.1"], "ns2.example.": ["192.0.2.2"]})
+    assert scanner.do_scan(["child.example.", "ns1.example.", "ns2.example."]) is None
+    assert events[-1] == ("child.example.", Event.CHILD_DNSKEY_INCONSISTENT)